@@ -1,21 +1,56 @@
 import os
 import random
-import base64
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from io import BytesIO
+from typing import Literal
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header
+from fastapi import FastAPI, Request, Response, UploadFile, File, HTTPException, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, HttpUrl
 from PIL import Image
 import httpx
+import orjson
+import pybase64
+
+try:
+    from cykooz_resizer import FilterType, ResizeAlg, ResizeOptions, Resizer
+
+    resizer = Resizer()
+    resize_options = ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.lanczos3))
+except (ImportError, TypeError, AttributeError):  # missing or incompatible; use Pillow
+    resizer = None
 
 # Configuration
 MASKS_DIR = Path(__file__).parent / "masks"
 MAX_IMAGE_SIZE_MB = 10
+MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SNIFF_SIZE = 16
 ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
+OUTPUT_CONTENT_TYPES = {"png": "image/png", "webp": "image/webp"}
 REQUEST_TIMEOUT = 30.0
+SCALED_MASK_CACHE_SIZE = 8
+# Entries are single-channel, so this caps the cache at ~32MB per worker
+SCALED_MASK_CACHE_MAX_PIXELS = 4_000_000
 API_KEY = os.environ.get("API_KEY")
+# os.cpu_count() reports host cores, not the container's CPU quota
+POOL_WORKERS = int(os.environ.get("POOL_WORKERS") or os.cpu_count() or 1)
+USE_TURBOJPEG = os.environ.get("USE_TURBOJPEG") == "1"
+
+turbo_jpeg = None
+if USE_TURBOJPEG:
+    try:
+        from turbojpeg import TJPF_RGB, TurboJPEG
+        turbo_jpeg = TurboJPEG()
+    except (ImportError, OSError, RuntimeError):  # binding or libturbojpeg missing
+        turbo_jpeg = None
 
 
 # API Key authentication
@@ -28,11 +63,43 @@ async def verify_api_key(x_api_key: str | None = Header(None, alias="X-API-Key")
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
 
+
+def create_executor() -> ProcessPoolExecutor:
+    """Create the worker pool; forkserver avoids forking the threaded server process."""
+    return ProcessPoolExecutor(
+        max_workers=POOL_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one pooled HTTP client and a worker pool for the app's lifetime."""
+    app.state.http_client = httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT,
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=64,
+            max_connections=128,
+            keepalive_expiry=30,
+        ),
+        headers={"User-Agent": "PhotoMaskingAPI/1.0"},
+    )
+    # Masking and encoding are CPU-bound, so run them outside the event loop and GIL
+    app.state.executor = create_executor()
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
+        app.state.executor.shutdown(wait=True)
+
+
 # FastAPI app
 app = FastAPI(
     title="Photo Masking API",
     description="API for applying decorative masks to photos",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -41,6 +108,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Raw endpoints report the mask name in a header browsers must be allowed to read
+    expose_headers=["X-Mask-Used"],
 )
 
 
@@ -49,6 +118,7 @@ class MaskByUrlRequest(BaseModel):
     url: HttpUrl
 
 
+# Documents the JSON endpoints; responses are serialized directly with orjson
 class MaskResponse(BaseModel):
     success: bool
     mask_used: str
@@ -57,73 +127,159 @@ class MaskResponse(BaseModel):
 
 
 # Helper functions
-def get_random_mask() -> tuple[Path, str]:
-    """Select a random mask file from the masks directory."""
-    mask_files = list(MASKS_DIR.glob("mask_*.png"))
-    if not mask_files:
+def load_masks() -> dict[str, Image.Image]:
+    """Decode every mask once and keep only its alpha channel ("L" mode)."""
+    masks = {}
+    for mask_path in sorted(MASKS_DIR.glob("mask_*.png")):
+        with Image.open(mask_path) as mask:
+            masks[mask_path.name] = mask.convert("RGBA").split()[3]
+    return masks
+
+
+# Masks are fixed at deploy time, so decode them once at import
+MASKS = load_masks()
+MASK_NAMES = tuple(MASKS)
+
+
+def get_random_mask() -> str:
+    """Select a random preloaded mask by name."""
+    if not MASK_NAMES:
         raise HTTPException(status_code=500, detail="No mask files found")
-    mask_path = random.choice(mask_files)
-    return mask_path, mask_path.name
+    return random.choice(MASK_NAMES)
+
+
+def resize_lanczos(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Lanczos-resize an image, using the SIMD resizer when available."""
+    if resizer is None:
+        return image.resize(size, Image.Resampling.LANCZOS)
+    resized = Image.new(image.mode, size)
+    resizer.resize_pil(image, resized, resize_options)
+    return resized
 
 
-def apply_mask(image_buffer: BytesIO, mask_path: Path) -> Image.Image:
+@lru_cache(maxsize=SCALED_MASK_CACHE_SIZE)
+def cached_scaled_mask_alpha(mask_name: str, size: tuple[int, int]) -> Image.Image:
+    """Resize a mask's alpha channel, memoized per (mask, size)."""
+    return resize_lanczos(MASKS[mask_name], size)
+
+
+def scaled_mask_alpha(mask_name: str, size: tuple[int, int]) -> Image.Image:
+    """
+    Resize a mask's alpha channel, reusing cached results for common sizes.
+    Photos from the same camera share dimensions, so repeats skip the resize;
+    large targets bypass the cache so memory doesn't scale with input size.
+    Callers must not modify the returned image.
+    """
+    if size[0] * size[1] > SCALED_MASK_CACHE_MAX_PIXELS:
+        return resize_lanczos(MASKS[mask_name], size)
+    return cached_scaled_mask_alpha(mask_name, size)
+
+
+def sniff_image_type(head: bytes) -> str | None:
+    """Identify an allowed image type from its leading magic bytes."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    return None
+
+
+def check_image_signature(head: bytes) -> None:
+    """Reject payloads whose magic bytes don't match an allowed image type."""
+    if sniff_image_type(head) is None:
+        raise HTTPException(status_code=400, detail="Content is not a supported image")
+
+
+def open_image(image_buffer: BytesIO) -> Image.Image:
+    """Open an image, decoding JPEGs with libjpeg-turbo when enabled."""
+    if turbo_jpeg is not None:
+        is_jpeg = sniff_image_type(image_buffer.read(SNIFF_SIZE)) == "image/jpeg"
+        image_buffer.seek(0)
+        if is_jpeg:
+            jpeg_data = image_buffer.getvalue()
+            try:
+                width, height, _, _ = turbo_jpeg.decode_header(jpeg_data)
+            except OSError:
+                pass  # Let Pillow handle JPEG variants TurboJPEG rejects
+            else:
+                # Decoding allocates the full frame up front, so run Pillow's own
+                # decompression bomb check (warn, then error at 2x the limit) first
+                Image._decompression_bomb_check((width, height))
+                try:
+                    # RGB, not RGBA: conversion to RGBA happens after the crop
+                    pixels = turbo_jpeg.decode(jpeg_data, pixel_format=TJPF_RGB)
+                    return Image.fromarray(pixels, "RGB")
+                except OSError:
+                    pass
+    return Image.open(image_buffer)
+
+
+def apply_mask(image_buffer: BytesIO, mask_name: str) -> Image.Image:
     """
     Apply mask as a crop shape to the image.
     Scales mask UP to match input image size for quality preservation.
     """
+    mask_width, mask_height = MASKS[mask_name].size
+
     try:
-        image = Image.open(image_buffer)
+        source = open_image(image_buffer)
+        try:
+            img_width, img_height = source.size
+
+            # Scale mask UP to fit input image (use smaller dimension to ensure mask fits)
+            scale_factor = min(img_width / mask_width, img_height / mask_height)
+            target_width = int(mask_width * scale_factor)
+            target_height = int(mask_height * scale_factor)
+
+            # Top-center crop the input image to mask dimensions before converting,
+            # so only the kept pixels go through the RGBA conversion
+            left = (img_width - target_width) // 2
+            top = 0  # Start from top for faces
+            image = source.crop((left, top, left + target_width, top + target_height))
+        finally:
+            # Free the full-resolution decode before the conversion and resize
+            source.close()
         if image.mode != "RGBA":
-            image = image.convert("RGBA")
+            cropped = image
+            try:
+                image = cropped.convert("RGBA")
+            finally:
+                cropped.close()
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Cannot open image: {str(e)}")
 
-    # Load mask
-    mask = Image.open(mask_path).convert("RGBA")
-    mask_width, mask_height = mask.size
-    img_width, img_height = image.size
-
-    # Scale mask UP to fit input image (use smaller dimension to ensure mask fits)
-    scale_factor = min(img_width / mask_width, img_height / mask_height)
-    target_width = int(mask_width * scale_factor)
-    target_height = int(mask_height * scale_factor)
-
     # Scale mask up to target size
-    mask = mask.resize((target_width, target_height), Image.Resampling.LANCZOS)
-
-    # Top-center crop the input image to mask dimensions
-    left = (img_width - target_width) // 2
-    top = 0  # Start from top for faces
-    image = image.crop((left, top, left + target_width, top + target_height))
+    mask_alpha = scaled_mask_alpha(mask_name, (target_width, target_height))
 
-    # Apply mask alpha channel
-    mask_alpha = mask.split()[3]
-    output = Image.new("RGBA", (target_width, target_height), (0, 0, 0, 0))
-    output.paste(image, (0, 0))
-    output.putalpha(mask_alpha)
+    # Apply mask alpha channel directly; the crop is already mask-sized
+    image.putalpha(mask_alpha)
 
-    return output
+    return image
 
 
-def image_to_base64(image: Image.Image) -> str:
-    """Convert PIL Image to base64-encoded PNG string."""
+def encode_image(image: Image.Image, output_format: str = "png") -> BytesIO:
+    """Encode PIL Image as PNG (or lossy WebP) into a BytesIO buffer."""
     buffer = BytesIO()
-    image.save(buffer, format="PNG", optimize=True)
-    buffer.seek(0)
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    if output_format == "webp":
+        # Lossy WebP keeps alpha and is far cheaper to encode than PNG
+        image.save(buffer, format="WEBP", quality=85, method=4)
+    else:
+        # Fast zlib level: the response is one-shot, so optimize=True isn't worth the CPU
+        image.save(buffer, format="PNG", compress_level=1)
+    return buffer
 
 
-async def fetch_image_from_url(url: str) -> BytesIO:
-    """Fetch image from URL and return as BytesIO buffer."""
+async def fetch_image_from_url(url: str, client: httpx.AsyncClient) -> bytes | bytearray:
+    """Fetch image from URL using the shared client and return its bytes."""
     try:
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            response = await client.get(
-                url,
-                follow_redirects=True,
-                headers={"User-Agent": "PhotoMaskingAPI/1.0"},
-            )
+        async with client.stream("GET", url, follow_redirects=True) as response:
             response.raise_for_status()
 
+            # Content-Type is only an early filter; the body's magic bytes decide
             content_type = response.headers.get("content-type", "").split(";")[0]
             if content_type not in ALLOWED_CONTENT_TYPES:
                 raise HTTPException(
@@ -132,15 +288,54 @@ async def fetch_image_from_url(url: str) -> BytesIO:
                 )
 
             content_length = response.headers.get("content-length")
-            if content_length:
-                size_mb = int(content_length) / (1024 * 1024)
-                if size_mb > MAX_IMAGE_SIZE_MB:
+            if content_length and int(content_length) > MAX_IMAGE_SIZE_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Image exceeds maximum size of {MAX_IMAGE_SIZE_MB}MB",
+                )
+
+            # With a trustworthy Content-Length, stream straight into one
+            # preallocated buffer; compressed bodies decode to a different size
+            if content_length and "content-encoding" not in response.headers:
+                expected = int(content_length)
+                data = bytearray(expected)
+                view = memoryview(data)
+                offset = 0
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    if offset == 0:
+                        check_image_signature(chunk[:SNIFF_SIZE])
+                    end = offset + len(chunk)
+                    if end > expected:
+                        raise HTTPException(
+                            status_code=400,
+                            detail="Response body exceeds its Content-Length",
+                        )
+                    view[offset:end] = chunk
+                    offset = end
+                view.release()
+                if offset == 0:
+                    check_image_signature(b"")  # Empty body never reached the check
+                del data[offset:]
+                # Returned as-is: wrapping a bytearray in BytesIO would copy it
+                return data
+
+            # Otherwise enforce the size cap while streaming
+            buffer = BytesIO()
+            total = 0
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                if total == 0:
+                    check_image_signature(chunk[:SNIFF_SIZE])
+                total += len(chunk)
+                if total > MAX_IMAGE_SIZE_BYTES:
                     raise HTTPException(
                         status_code=413,
                         detail=f"Image exceeds maximum size of {MAX_IMAGE_SIZE_MB}MB",
                     )
+                buffer.write(chunk)
 
-            return BytesIO(response.content)
+            if total == 0:
+                check_image_signature(b"")  # Empty body never reached the check
+            return buffer.getvalue()
 
     except httpx.TimeoutException:
         raise HTTPException(status_code=400, detail="Request timed out")
@@ -150,20 +345,102 @@ async def fetch_image_from_url(url: str) -> BytesIO:
         raise HTTPException(status_code=400, detail=f"Request failed: {str(e)}")
 
 
-def process_image(image_buffer: BytesIO) -> dict:
+def mask_and_encode(contents: bytes | bytearray, output_format: str = "png") -> tuple[BytesIO, str]:
+    """Apply random mask and return the encoded image buffer and mask name."""
+    mask_name = get_random_mask()
+    with BytesIO(contents) as image_buffer:
+        processed_image = apply_mask(image_buffer, mask_name)
+    try:
+        return encode_image(processed_image, output_format), mask_name
+    finally:
+        processed_image.close()
+
+
+def render_image(contents: bytes | bytearray, output_format: str = "png") -> tuple[bytes, str]:
+    """Apply random mask and return the encoded image bytes and mask name."""
+    encoded, mask_name = mask_and_encode(contents, output_format)
+    with encoded:
+        return encoded.getvalue(), mask_name
+
+
+def process_image(contents: bytes | bytearray, output_format: str = "png") -> dict:
     """Apply random mask and return result."""
-    mask_path, mask_name = get_random_mask()
-    processed_image = apply_mask(image_buffer, mask_path)
-    base64_data = image_to_base64(processed_image)
+    encoded, mask_name = mask_and_encode(contents, output_format)
+    with encoded, encoded.getbuffer() as encoded_view:
+        base64_data = pybase64.b64encode(encoded_view).decode("ascii")
 
     return {
         "success": True,
         "mask_used": mask_name,
         "image_data": base64_data,
-        "content_type": "image/png",
+        "content_type": OUTPUT_CONTENT_TYPES[output_format],
     }
 
 
+class WorkerHTTPError(Exception):
+    """Picklable carrier for an HTTPException raised inside a pool worker."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def run_worker(func, *args):
+    """Call func in a pool worker, re-raising HTTPException in picklable form."""
+    try:
+        return func(*args)
+    except HTTPException as e:
+        raise WorkerHTTPError(e.status_code, e.detail) from None
+
+
+async def run_in_pool(app: FastAPI, func, *args):
+    """Run a CPU-bound pipeline step in the app's process pool."""
+    loop = asyncio.get_running_loop()
+    executor = app.state.executor
+    try:
+        return await loop.run_in_executor(executor, run_worker, func, *args)
+    except WorkerHTTPError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); replace the pool once so later requests recover
+        if app.state.executor is executor:
+            app.state.executor = create_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=503, detail="Image worker crashed, please retry")
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Validate an uploaded image file and return its bytes."""
+    # The client-supplied type is only an early filter; magic bytes decide
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type: {file.content_type}",
+        )
+
+    check_image_signature(await file.read(SNIFF_SIZE))
+    await file.seek(0)
+
+    contents = await file.read()
+    if len(contents) > MAX_IMAGE_SIZE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image exceeds maximum size of {MAX_IMAGE_SIZE_MB}MB",
+        )
+
+    return contents
+
+
+def raw_response(image_data: bytes, mask_name: str, output_format: str) -> Response:
+    """Wrap encoded image bytes in a binary response carrying the mask name."""
+    return Response(
+        content=image_data,
+        media_type=OUTPUT_CONTENT_TYPES[output_format],
+        headers={"X-Mask-Used": mask_name},
+    )
+
+
 # Endpoints
 @app.get("/health")
 async def health_check():
@@ -181,55 +458,110 @@ async def root():
         "endpoints": {
             "mask_by_url": "POST /mask-by-url",
             "mask_by_upload": "POST /mask-by-upload",
+            "mask_by_url_raw": "POST /mask-by-url/raw",
+            "mask_by_upload_raw": "POST /mask-by-upload/raw",
         },
     }
 
 
-@app.post("/mask-by-url", response_model=MaskResponse)
+@app.post(
+    "/mask-by-url",
+    response_class=JSONResponse,
+    response_model=None,
+    responses={200: {"model": MaskResponse}},
+)
 async def mask_photo_by_url(
     request: MaskByUrlRequest,
+    http_request: Request,
+    output_format: Literal["png", "webp"] = Query("png", alias="format"),
     _: bool = Depends(verify_api_key)
 ):
     """
     Apply a random mask to an image fetched from a URL.
 
     The image is cropped to the mask shape, with transparent areas
-    of the mask becoming transparent in the output.
+    of the mask becoming transparent in the output. Pass ?format=webp
+    for a faster-to-encode lossy WebP instead of PNG.
 
     Requires X-API-Key header.
     """
-    image_buffer = await fetch_image_from_url(str(request.url))
-    result = process_image(image_buffer)
-    return MaskResponse(**result)
-
-
-@app.post("/mask-by-upload", response_model=MaskResponse)
+    contents = await fetch_image_from_url(
+        str(request.url), http_request.app.state.http_client
+    )
+    result = await run_in_pool(
+        http_request.app, process_image, contents, output_format
+    )
+    return Response(orjson.dumps(result), media_type="application/json")
+
+
+@app.post(
+    "/mask-by-upload",
+    response_class=JSONResponse,
+    response_model=None,
+    responses={200: {"model": MaskResponse}},
+)
 async def mask_photo_by_upload(
+    http_request: Request,
     file: UploadFile = File(...),
+    output_format: Literal["png", "webp"] = Query("png", alias="format"),
     _: bool = Depends(verify_api_key)
 ):
     """
     Apply a random mask to an uploaded image file.
 
     Accepts: JPEG, PNG, WebP, GIF
-    Returns: Base64-encoded PNG with mask applied
+    Returns: Base64-encoded PNG (or WebP with ?format=webp) with mask applied
 
     Requires X-API-Key header.
     """
-    if file.content_type not in ALLOWED_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file type: {file.content_type}",
-        )
+    contents = await read_upload(file)
+    result = await run_in_pool(
+        http_request.app, process_image, contents, output_format
+    )
+    return Response(orjson.dumps(result), media_type="application/json")
 
-    contents = await file.read()
-    size_mb = len(contents) / (1024 * 1024)
-    if size_mb > MAX_IMAGE_SIZE_MB:
-        raise HTTPException(
-            status_code=413,
-            detail=f"Image exceeds maximum size of {MAX_IMAGE_SIZE_MB}MB",
-        )
 
-    image_buffer = BytesIO(contents)
-    result = process_image(image_buffer)
-    return MaskResponse(**result)
+@app.post("/mask-by-url/raw", response_class=Response)
+async def mask_photo_by_url_raw(
+    request: MaskByUrlRequest,
+    http_request: Request,
+    output_format: Literal["png", "webp"] = Query("png", alias="format"),
+    _: bool = Depends(verify_api_key)
+):
+    """
+    Apply a random mask to an image fetched from a URL.
+
+    Returns the image bytes directly instead of base64 JSON;
+    the mask name is in the X-Mask-Used header.
+
+    Requires X-API-Key header.
+    """
+    contents = await fetch_image_from_url(
+        str(request.url), http_request.app.state.http_client
+    )
+    image_data, mask_name = await run_in_pool(
+        http_request.app, render_image, contents, output_format
+    )
+    return raw_response(image_data, mask_name, output_format)
+
+
+@app.post("/mask-by-upload/raw", response_class=Response)
+async def mask_photo_by_upload_raw(
+    http_request: Request,
+    file: UploadFile = File(...),
+    output_format: Literal["png", "webp"] = Query("png", alias="format"),
+    _: bool = Depends(verify_api_key)
+):
+    """
+    Apply a random mask to an uploaded image file.
+
+    Returns the image bytes directly instead of base64 JSON;
+    the mask name is in the X-Mask-Used header.
+
+    Requires X-API-Key header.
+    """
+    contents = await read_upload(file)
+    image_data, mask_name = await run_in_pool(
+        http_request.app, render_image, contents, output_format
+    )
+    return raw_response(image_data, mask_name, output_format)
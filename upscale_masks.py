@@ -1,33 +1,42 @@
+import asyncio
+
 import replicate
 from io import BytesIO
 from pathlib import Path
 from PIL import Image
 
 MASKS_DIR = Path(__file__).parent / "masks"
+MAX_CONCURRENT_UPSCALES = 8
+
 
-for mask_file in sorted(MASKS_DIR.glob("mask_[0-9].png")):
+async def upscale_mask(mask_file: Path, semaphore: asyncio.Semaphore) -> None:
     with Image.open(mask_file) as img:
         orig_size = img.size
         print(f"Upscaling {mask_file.name} ({orig_size[0]}x{orig_size[1]})...")
 
         # Extract alpha channel and convert to RGB grayscale image for upscaling
         alpha = img.split()[-1]  # Get alpha channel
-        # Convert alpha to RGB (grayscale) so Replicate can process it
-        alpha_rgb = Image.merge("RGB", (alpha, alpha, alpha))
+        # Convert alpha to RGB (grayscale) so Replicate can process it;
+        # L -> RGB conversion replicates the channel in a single pass
+        alpha_rgb = alpha.convert("RGB")
 
-        # Save temporarily for upload
-        temp_path = mask_file.with_suffix(".temp.png")
-        alpha_rgb.save(temp_path, "PNG")
+        # Encode in memory for upload; the name lets Replicate type it as PNG
+        upload = BytesIO()
+        upload.name = f"{mask_file.stem}.png"
+        alpha_rgb.save(upload, "PNG")
+        upload.seek(0)
 
-    # Upscale the alpha channel with Replicate
-    with open(temp_path, "rb") as f:
-        output = replicate.run(
+    # Upscale the alpha channel with Replicate; round-trips dominate, so
+    # masks are processed concurrently up to the semaphore limit
+    async with semaphore:
+        output = await replicate.async_run(
             "recraft-ai/recraft-crisp-upscale",
-            input={"image": f}
+            input={"image": upload}
         )
+        upscaled_bytes = await output.aread()
 
     # Load upscaled result
-    upscaled_alpha_rgb = Image.open(BytesIO(output.read()))
+    upscaled_alpha_rgb = Image.open(BytesIO(upscaled_bytes))
 
     # Extract one channel as the new alpha (convert from RGB back to single channel)
     upscaled_alpha = upscaled_alpha_rgb.convert("L")
@@ -44,9 +53,28 @@ for mask_file in sorted(MASKS_DIR.glob("mask_[0-9].png")):
     # Save final result
     result.save(mask_file, "PNG")
 
-    # Clean up temp file
-    temp_path.unlink()
-
     print(f"  Done: {mask_file.name} -> {new_size[0]}x{new_size[1]}")
 
-print("\nAll masks upscaled!")
+
+async def main() -> None:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSCALES)
+    mask_files = sorted(MASKS_DIR.glob("mask_[0-9].png"))
+    results = await asyncio.gather(
+        *(upscale_mask(mask_file, semaphore) for mask_file in mask_files),
+        return_exceptions=True,
+    )
+
+    failed = False
+    for mask_file, result in zip(mask_files, results):
+        if isinstance(result, Exception):
+            failed = True
+            print(f"  Failed: {mask_file.name}: {result}")
+
+    if failed:
+        print("\nSome masks failed to upscale.")
+        raise SystemExit(1)
+    print("\nAll masks upscaled!")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())